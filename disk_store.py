@@ -19,24 +19,16 @@ Typical usage example:
     # it also supports dictionary style API too:
     disk["hamlet"] = "shakespeare"
 """
+import array
+import collections
+import mmap
 import os.path
+import threading
 import time
 import typing
+import zlib
 
-from format import KeyEntry, encode_kv, decode_kv, HEADER_SIZE, decode_header
-
-# We use `file.seek` method to move our cursor to certain byte offset for read
-# or write operations. The method takes two parameters file.seek(offset, whence).
-# The offset says the byte offset and whence says the direction:
-#
-# whence 0 - beginning of the file
-# whence 1 - current cursor position
-# whence 2 - end of the file
-#
-# read more about it here:
-# https://docs.python.org/3.7/tutorial/inputoutput.html#methods-of-file-objects
-DEFAULT_WHENCE: typing.Final[int] = 0
-
+from format import KeyEntry, encode_kv_bytes, HEADER, HEADER_SIZE, CRC_SIZE
 
 # DiskStorage is a Log-Structured Hash Table as described in the BitCask paper. We
 # keep appending the data to a file, like a log. DiskStorage maintains an in-memory
@@ -65,6 +57,76 @@ DEFAULT_WHENCE: typing.Final[int] = 0
 # Read the paper for more details: https://riak.com/assets/bitcask-intro.pdf
 
 
+class KeyDir:
+    """
+    KeyDir is the in-memory hash table which maps a key to the location of its latest
+    record on the disk. It holds the same data as a dict of KeyEntry objects, but
+    stores the fields column-wise: `rows` maps each key to a row number, and the row
+    number indexes into the compact typed arrays holding the fields. This saves us
+    a Python object per key and the ints inside it, which adds up quickly since
+    KeyDir has to hold every key of the database in memory
+
+    The keys are kept as UTF-8 encoded bytes, the same form they have on the disk.
+    DiskStorage encodes the key once at its API boundary and uses the bytes for
+    everything else, and the initialisation does not need to decode the keys at all
+
+    Attributes:
+        rows (dict[bytes, int]): maps the key to its row in the arrays below
+        timestamps (array.array[int]): KeyEntry.timestamp of each row
+        positions (array.array[int]): KeyEntry.position of each row
+        total_sizes (array.array[int]): KeyEntry.total_size of each row
+    """
+
+    def __init__(self) -> None:
+        self.rows: dict[bytes, int] = {}
+        # `I` - unsigned int (4 bytes), same as the timestamp on the disk
+        # `Q` - unsigned long long (8 bytes), since the file and the records can
+        #       grow larger than 4GB
+        self.timestamps: "array.array[int]" = array.array("I")
+        self.positions: "array.array[int]" = array.array("Q")
+        self.total_sizes: "array.array[int]" = array.array("Q")
+
+    def set(self, key: bytes, timestamp: int, position: int, total_size: int) -> None:
+        row: typing.Optional[int] = self.rows.get(key)
+        if row is None:
+            self.rows[key] = len(self.positions)
+            self.timestamps.append(timestamp)
+            self.positions.append(position)
+            self.total_sizes.append(total_size)
+            return
+        self.timestamps[row] = timestamp
+        self.positions[row] = position
+        self.total_sizes[row] = total_size
+
+    def locate(self, key: bytes) -> typing.Optional[tuple[int, int]]:
+        """
+        locate returns the position and the total size of the latest record of the
+        key, or None if the key does not exist. Unlike get, it does not build a
+        KeyEntry, which makes it cheaper for the hot paths that need only these two
+        fields
+        """
+        row: typing.Optional[int] = self.rows.get(key)
+        if row is None:
+            return None
+        return self.positions[row], self.total_sizes[row]
+
+    def get(self, key: bytes) -> typing.Optional[KeyEntry]:
+        row: typing.Optional[int] = self.rows.get(key)
+        if row is None:
+            return None
+        return KeyEntry(
+            timestamp=self.timestamps[row],
+            position=self.positions[row],
+            total_size=self.total_sizes[row],
+        )
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+
 class DiskStorage:
     """
     Implements the KV store on the disk
@@ -73,32 +135,107 @@ class DiskStorage:
         file_name (str): name of the file where all the data will be written. Just
             passing the file name will save the data in the current directory. You may
             pass the full file location too.
+        sync_interval (typing.Optional[float]): if given, a background thread syncs
+            the file to the disk every `sync_interval` seconds (group commit).
+            Otherwise, the data is persisted only on `sync()` and `close()`. It must
+            be positive, else ValueError is raised
+        cache_size (int): maximum total size in bytes of the values kept in the
+            in-memory LRU cache. Values larger than this are never cached. Pass 0 to
+            disable the cache
 
     Attributes:
         file_name (str): name of the file where all the data will be written. Just
             passing the file name will save the data in the current directory. You may
             pass the full file location too.
-        file (typing.BinaryIO): file object pointing the file_name
+        fd (int): file descriptor of the file_name, opened for appending and reading
+        mm (typing.Optional[mmap.mmap]): read only memory map of the file, used to
+            serve the reads. It is None while the file is empty
         write_position (int): current cursor position in the file where the data can be
             written
-        key_dir (dict[str, KeyEntry]): is a map of key and KeyEntry being the value.
-            KeyEntry contains the position of the byte offset in the file where the
-            value exists. key_dir map acts as in-memory index to fetch the values
-            quickly from the disk
+        key_dir (KeyDir): is a map of key to the location of its latest record, i.e.
+            the byte offset in the file where the record starts and its size. key_dir
+            map acts as in-memory index to fetch the values quickly from the disk
     """
 
-    def __init__(self, file_name: str = "data.db"):
+    def __init__(
+        self,
+        file_name: str = "data.db",
+        sync_interval: typing.Optional[float] = None,
+        cache_size: int = 1024 * 1024,
+    ):
+        # with a zero or negative interval the group commit thread would call fsync
+        # in a tight loop
+        if sync_interval is not None and sync_interval <= 0:
+            raise ValueError(f"sync_interval must be positive, got {sync_interval}")
         self.file_name: str = file_name
         self.write_position: int = 0
-        self.key_dir: dict[str, KeyEntry] = {}
+        self.key_dir: KeyDir = KeyDir()
         # if the file exists already, then we will load the key_dir
         if os.path.exists(file_name):
             self._init_key_dir()
-        # we open the file in `a+b` mode:
-        # a - says the writes are append only. `a+` means we want append and read
-        # b - says that we are operating the file in binary mode (as opposed to the
-        #     default string mode)
-        self.file: typing.BinaryIO = open(file_name, "a+b")
+        # we open the file with a raw file descriptor instead of `open`. The file
+        # object returned by `open` buffers the writes, which only adds a copy and a
+        # flush for us, since we want every write to reach the OS right away:
+        # O_RDWR - we want to read (for the reads through mmap and pread) and write
+        # O_CREAT - create the file if it doesn't exist
+        # O_APPEND - the writes are append only, the OS moves the offset to the end
+        #     of the file atomically with each write
+        # O_BINARY - only exists on Windows, where the files are opened in text mode
+        #     by default
+        flags: int = os.O_RDWR | os.O_CREAT | os.O_APPEND | getattr(os, "O_BINARY", 0)
+        self.fd: int = os.open(file_name, flags, 0o644)
+        # reads are point lookups at random offsets, so the kernel's readahead only
+        # wastes I/O on pages we are never going to touch. posix_fadvise and
+        # madvise are not available on all the platforms (e.g. Windows)
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_RANDOM)
+        # reads are served from a memory map of the file instead of seeking and
+        # reading through the file object. Slicing the map copies only the bytes of
+        # the record, and the OS page cache takes care of the rest
+        self.mm: typing.Optional[mmap.mmap] = None
+        # the group commit thread may replace the map while a get is reading from
+        # it, so every access to self.mm happens under this lock
+        self._mm_lock: threading.Lock = threading.Lock()
+        with self._mm_lock:
+            self._remap()
+        # most workloads read a small set of hot keys over and over again. We keep
+        # the recently read values in memory, keyed by the byte offset of their
+        # record, and evict the least recently used ones once the cache is full.
+        # The cache is bounded by the total size of the values it holds, not by
+        # their count, since a few large values can take a lot of memory. Along
+        # with each value, we keep its size in bytes
+        self._cache: collections.OrderedDict[int, tuple[str, int]] = (
+            collections.OrderedDict()
+        )
+        self._cache_bytes: int = 0
+        self._cache_size: int = cache_size
+        # the cache and its size are updated together, and the reads may happen
+        # concurrently, so every access to the cache happens under this lock
+        self._cache_lock: threading.Lock = threading.Lock()
+        self._closed: threading.Event = threading.Event()
+        self._syncer: typing.Optional[threading.Thread] = None
+        # if a background sync fails, the group commit thread stops and keeps the
+        # error here. The writes are not persisted anymore, so we raise it to the
+        # caller from the next set, sync or close
+        self._sync_error: typing.Optional[Exception] = None
+        # the timestamps have a resolution of one second. If the group commit ticks
+        # at least once a second, a second thread refreshes the current timestamp at
+        # the same interval, so the writes don't need to read the clock themselves.
+        # It is a separate thread so that a slow or failing fsync cannot hold the
+        # timestamp back
+        self._timestamp: typing.Optional[int] = None
+        self._clock: typing.Optional[threading.Thread] = None
+        if sync_interval is not None:
+            self._syncer = threading.Thread(
+                target=self._group_commit, args=(sync_interval,), daemon=True
+            )
+            self._syncer.start()
+            if sync_interval <= 1:
+                self._timestamp = int(time.time())
+                self._clock = threading.Thread(
+                    target=self._tick, args=(sync_interval,), daemon=True
+                )
+                self._clock.start()
 
     def set(self, key: str, value: str) -> None:
         """
@@ -107,19 +244,27 @@ class DiskStorage:
         Args:
             key (str): the key
             value (str): the value
+
+        Raises:
+            Exception: the error which stopped the group commit thread, if any
         """
+        self._raise_sync_error()
         # The steps to save a KV to disk is simple:
         # 1. Encode the KV into bytes
         # 2. Write the bytes to disk by appending to the file
-        # 3. Update KeyDir with the KeyEntry of this key
-        timestamp: int = int(time.time())
-        sz, data = encode_kv(timestamp=timestamp, key=key, value=value)
+        # 3. Update KeyDir with the location of this record
+        timestamp: int = self._now()
+        key_bytes: bytes = key.encode("utf-8")
+        value_bytes: bytes = value.encode("utf-8")
+        sz, data = encode_kv_bytes(timestamp, key_bytes, value_bytes)
         # notice we don't do file seek while writing
         self._write(data)
-        kv: KeyEntry = KeyEntry(
-            timestamp=timestamp, position=self.write_position, total_size=sz
-        )
-        self.key_dir[key] = kv
+        # the old record of this key is not reachable anymore, drop its value
+        old: typing.Optional[tuple[int, int]] = self.key_dir.locate(key_bytes)
+        if old is not None:
+            with self._cache_lock:
+                self._cache_drop(old[0])
+        self.key_dir.set(key_bytes, timestamp, self.write_position, sz)
         # update last write position, so that next record can be written from this point
         self.write_position += sz
 
@@ -135,67 +280,215 @@ class DiskStorage:
             string
         """
         # How get works?
-        # 1. Check if there is any KeyEntry record for the key in KeyDir
+        # 1. Check if KeyDir has the location of the key's record
         # 2. Return an empty string if key doesn't exist
-        # 3. If it exists, then read KeyEntry.total_size bytes starting from the
-        #    KeyEntry.position from the disk
-        # 4. Decode the bytes into valid KV pair and return the value
-        kv: typing.Optional[KeyEntry] = self.key_dir.get(key)
-        if not kv:
+        # 3. If it exists, then the value is the last part of the record which starts
+        #    at its position and spans its total size in bytes. We already know the
+        #    size of the header and the key, so we skip them
+        # 4. Read the value bytes from the disk and decode them
+        #
+        # Notice that we don't need to decode the whole record, the header and the
+        # key are never read on this path
+        key_bytes: bytes = key.encode("utf-8")
+        location: typing.Optional[tuple[int, int]] = self.key_dir.locate(key_bytes)
+        if location is None:
             return ""
-        #  move the current pointer to the right offset
-        self.file.seek(kv.position, DEFAULT_WHENCE)
-        data: bytes = self.file.read(kv.total_size)
-        _, _, value = decode_kv(data)
+        position, total_size = location
+        with self._cache_lock:
+            cached: typing.Optional[tuple[str, int]] = self._cache.get(position)
+            if cached is not None:
+                self._cache.move_to_end(position)
+                return cached[0]
+        start: int = position + HEADER_SIZE + len(key_bytes)
+        end: int = position + total_size
+        value: str = self._read(start, end).decode("utf-8")
+        size: int = end - start
+        if 0 < self._cache_size and size <= self._cache_size:
+            with self._cache_lock:
+                self._cache_drop(position)
+                self._cache[position] = (value, size)
+                self._cache_bytes += size
+                while self._cache_bytes > self._cache_size:
+                    _, (_, evicted) = self._cache.popitem(last=False)
+                    self._cache_bytes -= evicted
         return value
 
+    def _cache_drop(self, position: int) -> None:
+        # the caller must hold self._cache_lock
+        cached: typing.Optional[tuple[str, int]] = self._cache.pop(position, None)
+        if cached is not None:
+            self._cache_bytes -= cached[1]
+
+    def _read(self, start: int, end: int) -> bytes:
+        # the map covers the file as it was at the time of mapping, so the records
+        # written after that are not visible through it. Remapping the file on every
+        # such read is costly when sets and gets alternate, so we read these records
+        # with `os.pread` instead, which reads the exact bytes at the given offset
+        # in a single syscall. It does not move the file cursor either, so the reads
+        # don't interfere with each other or with the writes. The map is refreshed
+        # on DiskStorage.sync()
+        with self._mm_lock:
+            if self.mm is not None and end <= len(self.mm):
+                return self.mm[start:end]
+        if hasattr(os, "pread"):
+            return os.pread(self.fd, end - start, start)
+        # os.pread is not available on Windows
+        with self._mm_lock:
+            mm: typing.Optional[mmap.mmap] = self._remap()
+            assert mm is not None
+            return mm[start:end]
+
+    def _remap(self) -> typing.Optional[mmap.mmap]:
+        # the caller must hold self._mm_lock. We close the old map right away
+        # instead of leaving it to the garbage collector: on Windows a mapped file
+        # cannot be deleted, and runtimes like PyPy may keep it alive for long
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        # mmap cannot map an empty file
+        if os.fstat(self.fd).st_size == 0:
+            return None
+        mm: mmap.mmap = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, "MADV_RANDOM"):
+            mm.madvise(mmap.MADV_RANDOM)
+        self.mm = mm
+        return mm
+
     def _write(self, data: bytes) -> None:
         # saving stuff to a file reliably is hard!
         # if you would like to explore and learn more, then
         # start from here: https://danluu.com/file-consistency/
         # and read this too: https://lwn.net/Articles/457667/
-        self.file.write(data)
-        # we need to call flush after every write so that our data is moved from
-        # runtime buffer to the os buffer
+        #
+        # os.write hands the data to the OS buffer directly. Once it is in the os
+        # buffer, the reads see it too, even though it may not be on the disk yet.
+        # The write may be partial, so we keep writing till all the bytes are done
+        view: memoryview = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view) :]
+        # we don't fsync here: fsync is expensive and calling it after every write
+        # makes the writes slow. Check DiskStorage.sync() to see how the writes are
+        # persisted
+
+    def sync(self) -> None:
+        """
+        sync persists all the writes done so far to the disk
+
+        Raises:
+            Exception: the error which stopped the group commit thread, if any
+        """
+        self._raise_sync_error()
+        self._sync()
+
+    def _sync(self) -> None:
         # read more about here: https://docs.python.org/3/library/os.html#os.fsync
-        self.file.flush()
-        # calling fsync after every write is important, this assures that our writes
-        # are actually persisted to the disk
-        os.fsync(self.file.fileno())
+        os.fsync(self.fd)
+        # make the records written since the last sync readable through the map
+        with self._mm_lock:
+            if self.mm is None or len(self.mm) < self.write_position:
+                self._remap()
+
+    def _group_commit(self, interval: float) -> None:
+        # instead of calling fsync for each write, we sync all the writes done in
+        # the last interval together
+        while not self._closed.wait(interval):
+            try:
+                self._sync()
+            except Exception as e:
+                self._sync_error = e
+                return
+
+    def _raise_sync_error(self) -> None:
+        if self._sync_error is not None:
+            raise self._sync_error
+
+    def _tick(self, interval: float) -> None:
+        try:
+            while not self._closed.wait(interval):
+                self._timestamp = int(time.time())
+        finally:
+            # once the thread stops, nobody refreshes the timestamp anymore, so the
+            # writes go back to reading the clock
+            self._timestamp = None
+
+    def _now(self) -> int:
+        timestamp: typing.Optional[int] = self._timestamp
+        if timestamp is not None:
+            return timestamp
+        return int(time.time())
 
     def _init_key_dir(self) -> None:
         # we will initialise the key_dir by reading the contents of the file, record by
-        # record. As we read each record, we will also update our KeyDir with the
-        # corresponding KeyEntry
+        # record. As we read each record, we will also update our KeyDir with its
+        # location
         #
         # NOTE: this method is a blocking one, if the DB size is yuge then it will take
         # a lot of time to startup
         print("****----------initialising the database----------****")
         with open(self.file_name, "rb") as f:
-            while header_bytes := f.read(HEADER_SIZE):
-                timestamp, key_size, value_size = decode_header(data=header_bytes)
-                key_bytes = f.read(key_size)
-                value_bytes = f.read(value_size)
-                key = key_bytes.decode("utf-8")
-                value = value_bytes.decode("utf-8")
-                total_size = HEADER_SIZE + key_size + value_size
-                kv = KeyEntry(
-                    timestamp=timestamp,
-                    position=self.write_position,
-                    total_size=total_size,
+            # unlike the reads, the initialisation scans the file from start to end
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            data: bytes = f.read()
+        # slicing a memoryview does not copy the underlying bytes, so we can walk
+        # through the records without creating a new object for each of them. We
+        # only need to copy the key of each record, the value is just checksummed
+        view: memoryview = memoryview(data)
+        # this loop runs once per record, so we keep everything it needs in local
+        # variables. Looking up a local is much cheaper than looking up an attribute
+        # or a global on every iteration
+        unpack_from = HEADER.unpack_from
+        crc32 = zlib.crc32
+        key_dir_set = self.key_dir.set
+        position: int = 0
+        size: int = len(data)
+        while position < size:
+            # a crash in the middle of a write can leave a partial record at the end
+            # of the file. The checksum cannot catch it if even the header is cut
+            if position + HEADER_SIZE > size:
+                raise ValueError(
+                    f"partial header at byte offset {position}, "
+                    f"{self.file_name} is corrupt"
+                )
+            crc, timestamp, key_size, value_size = unpack_from(view, position)
+            key_start: int = position + HEADER_SIZE
+            total_size: int = HEADER_SIZE + key_size + value_size
+            if position + total_size > size:
+                raise ValueError(
+                    f"partial record at byte offset {position}, "
+                    f"{self.file_name} is corrupt"
+                )
+            # the reads don't verify the checksum to keep them fast, so this is
+            # where we catch the corrupt records
+            if crc32(view[position + CRC_SIZE : position + total_size]) != crc:
+                raise ValueError(
+                    f"crc mismatch at byte offset {position}, "
+                    f"{self.file_name} is corrupt"
                 )
-                self.key_dir[key] = kv
-                self.write_position += total_size
-                print(f"loaded k={key}, v={value}")
+            key: bytes = bytes(view[key_start : key_start + key_size])
+            key_dir_set(key, timestamp, position, total_size)
+            position += total_size
+        self.write_position = position
         print("****----------initialisation complete----------****")
 
     def close(self) -> None:
-        # before we close the file, we need to safely write the contents in the buffers
-        # to the disk. Check documentation of DiskStorage._write() to understand
+        # before we close the file, we need to safely write the contents in the OS
+        # buffers to the disk. Check documentation of DiskStorage.sync() to understand
         # following the operations
-        self.file.flush()
-        os.fsync(self.file.fileno())
-        self.file.close()
+        self._closed.set()
+        if self._syncer is not None:
+            self._syncer.join()
+        if self._clock is not None:
+            self._clock.join()
+        try:
+            self._sync()
+        finally:
+            with self._mm_lock:
+                if self.mm is not None:
+                    self.mm.close()
+                    self.mm = None
+            os.close(self.fd)
+        self._raise_sync_error()
 
     def __setitem__(self, key: str, value: str) -> None:
         return self.set(key, value)
@@ -38,28 +38,36 @@ For the workshop, the functions will have the following signature:
 
 import struct
 import typing
+import zlib
 
 # Our key value pair, when stored on disk looks like this:
-#   ┌───────────┬──────────┬────────────┬─────┬───────┐
-#   │ timestamp │ key_size │ value_size │ key │ value │
-#   └───────────┴──────────┴────────────┴─────┴───────┘
+#   ┌─────┬───────────┬──────────┬────────────┬─────┬───────┐
+#   │ crc │ timestamp │ key_size │ value_size │ key │ value │
+#   └─────┴───────────┴──────────┴────────────┴─────┴───────┘
 #
 # This is analogous to a typical database's row (or a record). The total length of
 # the row is variable, depending on the contents of the key and value.
 #
-# The first three fields form the header:
-#   ┌───────────────┬──────────────┬────────────────┐
-#   │ timestamp(4B) │ key_size(4B) │ value_size(4B) │
-#   └───────────────┴──────────────┴────────────────┘
+# The first four fields form the header:
+#   ┌─────────┬───────────────┬──────────────┬────────────────┐
+#   │ crc(4B) │ timestamp(4B) │ key_size(4B) │ value_size(4B) │
+#   └─────────┴───────────────┴──────────────┴────────────────┘
 #
-# These three fields store unsigned integers of size 4 bytes, giving our header a
-# fixed length of 12 bytes. Timestamp field stores the time the record we
+# These four fields store unsigned integers of size 4 bytes, giving our header a
+# fixed length of 16 bytes. Timestamp field stores the time the record we
 # inserted in unix epoch seconds. Key size and value size fields store the length of
 # bytes occupied by the key and value. The maximum integer
 # stored by 4 bytes is 4,294,967,295 (2 ** 32 - 1), roughly ~4.2GB. So, the size of
 # each key or value cannot exceed this. Theoretically, a single row can be as large
 # as ~8.4GB.
 #
+# Like in the BitCask paper, the crc field is a CRC-32 checksum of rest of the row,
+# i.e. everything from the timestamp till the end of the value. When we read the row
+# back, we calculate the checksum again and compare it with the stored one to detect
+# corrupt rows. A row cut short before the end of its header has no checksum to
+# compare, so the readers check the lengths first to detect partially written rows.
+# We use `zlib.crc32`, which comes with the standard library and is implemented in C.
+#
 # We use `struct.pack` method to serialise our header to bytes. `struct.pack` function
 # looks like this:
 #
@@ -71,16 +79,25 @@ import typing
 # to understand how to construct such a string.
 #
 # `<` - lil endian to be used to encode the integer
-# `L` - represents long unsigned int (4 bytes). We have three fields, hence `LLL`
-HEADER_FORMAT: typing.Final[str] = "<LLL"
-HEADER_SIZE: typing.Final[int] = 12
+# `L` - represents long unsigned int (4 bytes). We have four fields, hence `LLLL`
+HEADER_FORMAT: typing.Final[str] = "<LLLL"
+# `struct.pack` parses the format string on every call. `struct.Struct` compiles it
+# once and lets us reuse the compiled object for all the headers
+HEADER: typing.Final[struct.Struct] = struct.Struct(HEADER_FORMAT)
+HEADER_SIZE: typing.Final[int] = HEADER.size
+# while encoding, we need to pack the crc separately from rest of the header, since
+# the checksum can be calculated only after the other fields are encoded
+CRC: typing.Final[struct.Struct] = struct.Struct("<L")
+CRC_SIZE: typing.Final[int] = CRC.size
+FIELDS: typing.Final[struct.Struct] = struct.Struct("<LLL")
 
 
 class KeyEntry:
     """
     KeyEntry keeps the metadata about the KV, specially the position of
-    the byte offset in the file. Whenever we insert/update a key, we create a new
-    KeyEntry object and insert that into KeyDir.
+    the byte offset in the file. KeyDir stores these fields column-wise rather than
+    as KeyEntry objects, and builds a KeyEntry only when KeyDir.get asks for the
+    whole entry of a key.
 
     Args:
         timestamp (int): Timestamp at which we wrote the KV pair to the disk. The value
@@ -91,13 +108,20 @@ class KeyEntry:
             how many bytes we need to read from the file
     """
 
+    # KeyEntry is only the return type of KeyDir.get, the KeyDir itself stores the
+    # fields column-wise. We still declare the attributes upfront instead of keeping
+    # a `__dict__` per object, since the class holds just these three fields
+    __slots__ = ("timestamp", "position", "total_size")
+
     def __init__(self, timestamp: int, position: int, total_size: int):
         self.timestamp: int = timestamp
         self.position: int = position
         self.total_size: int = total_size
 
 
-def encode_header(timestamp: int, key_size: int, value_size: int) -> bytes:
+def encode_header(
+    timestamp: int, key_size: int, value_size: int, crc: int = 0
+) -> bytes:
     """
     encode_header encodes the data into bytes using the `HEADER_FORMAT` format
     string
@@ -107,6 +131,8 @@ def encode_header(timestamp: int, key_size: int, value_size: int) -> bytes:
             is current time in seconds since the epoch.
         key_size (int): size of the key (cannot exceed the maximum)
         value_size (int): size of the value (cannot exceed the maximum)
+        crc (int): checksum of the row, check `encode_kv_bytes` on how it is
+            calculated
 
     Returns:
         byte object containing the encoded data
@@ -114,7 +140,7 @@ def encode_header(timestamp: int, key_size: int, value_size: int) -> bytes:
     Raises:
         struct.error when parameters don't match the specific type / size
     """
-    return struct.pack(HEADER_FORMAT, timestamp, key_size, value_size)
+    return HEADER.pack(crc, timestamp, key_size, value_size)
 
 
 def encode_kv(timestamp: int, key: str, value: str) -> tuple[int, bytes]:
@@ -133,9 +159,37 @@ def encode_kv(timestamp: int, key: str, value: str) -> tuple[int, bytes]:
     Raises:
         struct.error when parameters don't match the specific type / size
     """
-    header: bytes = encode_header(timestamp, len(key), len(value))
-    data: bytes = b"".join([str.encode(key), str.encode(value)])
-    return HEADER_SIZE + len(data), header + data
+    # the sizes in the header are the number of bytes, which can be more than the
+    # number of characters in the string
+    return encode_kv_bytes(timestamp, key.encode("utf-8"), value.encode("utf-8"))
+
+
+def encode_kv_bytes(timestamp: int, key: bytes, value: bytes) -> tuple[int, bytes]:
+    """
+    encode_kv_bytes is same as encode_kv, but takes the KV pair which is already
+    encoded to bytes. Callers which hold the bytes can use it to avoid encoding
+    the strings again
+
+    Args:
+        timestamp (int): Timestamp at which we wrote the KV pair to the disk. The value
+            is current time in seconds since the epoch.
+        key (bytes): the key (cannot exceed the maximum size)
+        value (bytes): the value (cannot exceed the maximum size)
+
+    Returns:
+        tuple containing the size of encoded bytes and the byte object
+
+    Raises:
+        struct.error when parameters don't match the specific type / size
+    """
+    fields: bytes = FIELDS.pack(timestamp, len(key), len(value))
+    # crc32 takes the checksum of the previous part as its second argument, so we
+    # can calculate the checksum of the row without concatenating it first
+    crc: int = zlib.crc32(value, zlib.crc32(key, zlib.crc32(fields)))
+    # join computes the final size upfront and copies the header, key and value into
+    # a single new bytes object, so the key and value are copied only once
+    data: bytes = b"".join((CRC.pack(crc), fields, key, value))
+    return len(data), data
 
 
 def decode_kv(data: bytes) -> tuple[int, str, str]:
@@ -155,11 +209,15 @@ def decode_kv(data: bytes) -> tuple[int, str, str]:
     Raises:
         struct.error: when parameters don't match the specific type / size
         IndexError: if the length of bytes is shorter than expected
+        ValueError: if the checksum of the data does not match the stored crc
         UnicodeDecodeError: if the key or values bytes could not be decoded to string
     """
-    timestamp, key_size, value_size = struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])
-    key_bytes: bytes = data[HEADER_SIZE : HEADER_SIZE + key_size]
-    value_bytes: bytes = data[HEADER_SIZE + key_size :]
+    crc, timestamp, key_size, value_size = HEADER.unpack_from(data)
+    value_start: int = HEADER_SIZE + key_size
+    if zlib.crc32(data[CRC_SIZE : value_start + value_size]) != crc:
+        raise ValueError("crc mismatch, the data is corrupt")
+    key_bytes: bytes = data[HEADER_SIZE:value_start]
+    value_bytes: bytes = data[value_start : value_start + value_size]
     key: str = key_bytes.decode("utf-8")
     value: str = value_bytes.decode("utf-8")
     return timestamp, key, value
@@ -180,8 +238,11 @@ def decode_header(data: bytes) -> tuple[int, int, int]:
             key_size (int): size of the key
             value_size (int): size of the value
 
+        The crc is not returned, since it can be verified only along with the key
+        and value. Check `decode_kv`
+
     Raises:
         struct.error: when parameters don't match the specific type / size
     """
-    timestamp, key_size, value_size = struct.unpack(HEADER_FORMAT, data)
+    _, timestamp, key_size, value_size = HEADER.unpack(data)
     return timestamp, key_size, value_size
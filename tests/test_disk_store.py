@@ -1,9 +1,11 @@
 import os
 import tempfile
+import time
 import typing
 import unittest
+from unittest import mock
 
-from disk_store import DiskStorage
+from disk_store import DiskStorage, KeyDir
 
 
 class TempStorageFile:
@@ -39,6 +41,25 @@ class TempStorageFile:
         os.remove(self.path)
 
 
+class TestKeyDir(unittest.TestCase):
+    def test_set_get(self) -> None:
+        key_dir = KeyDir()
+        self.assertIsNone(key_dir.get(b"name"))
+        key_dir.set(b"name", 10, 0, 30)
+        key_dir.set(b"book", 10, 30, 30)
+        key_dir.set(b"name", 20, 60, 2**33)
+        self.assertEqual(len(key_dir), 2)
+        self.assertIn(b"book", key_dir)
+
+        kv = key_dir.get(b"name")
+        assert kv is not None
+        self.assertEqual(kv.timestamp, 20)
+        self.assertEqual(kv.position, 60)
+        self.assertEqual(kv.total_size, 2**33)
+        self.assertEqual(key_dir.locate(b"name"), (60, 2**33))
+        self.assertIsNone(key_dir.locate(b"hamlet"))
+
+
 class TestDiskCaskDB(unittest.TestCase):
     def setUp(self) -> None:
         self.file: TempStorageFile = TempStorageFile()
@@ -85,6 +106,160 @@ class TestDiskCaskDB(unittest.TestCase):
             self.assertEqual(store.get(k), v)
         store.close()
 
+    def test_set_after_reopen(self) -> None:
+        store = DiskStorage(file_name=self.file.path)
+        store.set("hamlet", "shakespeare")
+        store.close()
+
+        store = DiskStorage(file_name=self.file.path)
+        store.set("dune", "frank herbert")
+        self.assertEqual(store.get("hamlet"), "shakespeare")
+        self.assertEqual(store.get("dune"), "frank herbert")
+        store.set("hamlet", "william shakespeare")
+        self.assertEqual(store.get("hamlet"), "william shakespeare")
+        store.close()
+
+    def test_group_commit(self) -> None:
+        store = DiskStorage(file_name=self.file.path, sync_interval=0.01)
+        store.set("othello", "shakespeare")
+        store.sync()
+        self.assertEqual(store.get("othello"), "shakespeare")
+        kv = store.key_dir.get(b"othello")
+        assert kv is not None
+        self.assertAlmostEqual(kv.timestamp, time.time(), delta=2)
+        store.close()
+
+        store = DiskStorage(file_name=self.file.path)
+        self.assertEqual(store.get("othello"), "shakespeare")
+        store.close()
+
+    def test_remap_closes_old_map(self) -> None:
+        store = DiskStorage(file_name=self.file.path)
+        store.set("hamlet", "shakespeare")
+        store.sync()
+        old = store.mm
+        assert old is not None
+        store.set("dune", "frank herbert")
+        store.sync()
+        self.assertTrue(old.closed)
+        self.assertEqual(store.get("dune"), "frank herbert")
+        store.close()
+
+    def test_cache(self) -> None:
+        # enough room for any two of the values, but not all three
+        store = DiskStorage(file_name=self.file.path, cache_size=24)
+        store.set("hamlet", "shakespeare")
+        store.set("dune", "frank herbert")
+        store.set("anna karenina", "tolstoy")
+        for _ in range(2):
+            self.assertEqual(store.get("hamlet"), "shakespeare")
+            self.assertEqual(store.get("dune"), "frank herbert")
+            self.assertEqual(store.get("anna karenina"), "tolstoy")
+            self.assertEqual(len(store._cache), 2)
+            self.assertLessEqual(store._cache_bytes, 24)
+        store.set("hamlet", "william shakespeare")
+        self.assertEqual(store.get("hamlet"), "william shakespeare")
+        # a value larger than the cache is never cached
+        store.set("war and peace", "leo tolstoy, a very long novel indeed")
+        self.assertEqual(
+            store.get("war and peace"), "leo tolstoy, a very long novel indeed"
+        )
+        self.assertLessEqual(store._cache_bytes, 24)
+        store.close()
+
+    def test_no_cache(self) -> None:
+        store = DiskStorage(file_name=self.file.path, cache_size=0)
+        store.set("hamlet", "shakespeare")
+        self.assertEqual(store.get("hamlet"), "shakespeare")
+        store.sync()
+        store.set("dune", "frank herbert")
+        self.assertEqual(store.get("hamlet"), "shakespeare")
+        self.assertEqual(store.get("dune"), "frank herbert")
+        store.close()
+
+    def test_corrupt_file(self) -> None:
+        store = DiskStorage(file_name=self.file.path)
+        store.set("hamlet", "shakespeare")
+        store.close()
+
+        with open(self.file.path, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b"x")
+        self.assertRaises(ValueError, DiskStorage, self.file.path)
+
+    def test_truncated_file(self) -> None:
+        store = DiskStorage(file_name=self.file.path)
+        store.set("hamlet", "shakespeare")
+        store.set("dune", "frank herbert")
+        store.close()
+        size = os.path.getsize(self.file.path)
+
+        # the file ends in the middle of a header
+        with open(self.file.path, "ab") as f:
+            f.write(b"\x00" * 3)
+        self.assertRaises(ValueError, DiskStorage, self.file.path)
+
+        # the file ends in the middle of a key or value
+        with open(self.file.path, "r+b") as f:
+            f.truncate(size - 1)
+        self.assertRaises(ValueError, DiskStorage, self.file.path)
+
+    def test_cached_timestamp(self) -> None:
+        # the group commit thread ticks at least once a second, so the writes use
+        # the timestamp it keeps instead of reading the clock
+        store = DiskStorage(file_name=self.file.path, sync_interval=1)
+        cached = store._timestamp
+        assert cached is not None
+        with mock.patch("time.time", return_value=1234.0):
+            store.set("hamlet", "shakespeare")
+        kv = store.key_dir.get(b"hamlet")
+        assert kv is not None
+        self.assertEqual(kv.timestamp, cached)
+        store.close()
+
+    def test_timestamp_after_sync_error(self) -> None:
+        # a failing sync stops the group commit, but not the timestamp refresh
+        store = DiskStorage(file_name=self.file.path, sync_interval=0.01)
+        with mock.patch("os.fsync", side_effect=OSError("disk is gone")):
+            assert store._syncer is not None
+            store._syncer.join(timeout=5)
+        assert store._clock is not None
+        self.assertTrue(store._clock.is_alive())
+        self.assertRaises(OSError, store.close)
+        # and once the clock thread is gone, the writes read the clock again
+        self.assertIsNone(store._timestamp)
+        with mock.patch("time.time", return_value=1234.0):
+            self.assertEqual(store._now(), 1234)
+
+    def test_clock_timestamp(self) -> None:
+        # when the thread ticks less often than once a second, or there is no
+        # thread at all, the writes read the clock themselves
+        for interval in (5, None):
+            store = DiskStorage(file_name=self.file.path, sync_interval=interval)
+            self.assertIsNone(store._timestamp)
+            with mock.patch("time.time", return_value=1234.0):
+                store.set("hamlet", "shakespeare")
+            kv = store.key_dir.get(b"hamlet")
+            assert kv is not None
+            self.assertEqual(kv.timestamp, 1234)
+            store.close()
+
+    def test_group_commit_error(self) -> None:
+        store = DiskStorage(file_name=self.file.path, sync_interval=0.01)
+        with mock.patch("os.fsync", side_effect=OSError("disk is gone")):
+            assert store._syncer is not None
+            store._syncer.join(timeout=5)
+        self.assertFalse(store._syncer.is_alive())
+        self.assertRaises(OSError, store.set, "hamlet", "shakespeare")
+        self.assertRaises(OSError, store.sync)
+        self.assertRaises(OSError, store.close)
+
+    def test_invalid_sync_interval(self) -> None:
+        for interval in (0, -1):
+            self.assertRaises(
+                ValueError, DiskStorage, self.file.path, sync_interval=interval
+            )
+
     def test_deletion(self) -> None:
         store = DiskStorage(file_name=self.file.path)
 
@@ -6,6 +6,7 @@ import unittest
 import uuid
 
 from format import encode_header, decode_header, encode_kv, decode_kv, HEADER_SIZE
+from format import encode_kv_bytes
 from format import KeyEntry
 
 
@@ -79,6 +80,8 @@ class TestEncodeKV(unittest.TestCase):
         tests: typing.List[KeyValue] = [
             KeyValue(10, "hello", "world", HEADER_SIZE + 10),
             KeyValue(0, "", "", HEADER_SIZE),
+            # sizes are in bytes, not characters
+            KeyValue(10, "война и мир", "толстой", HEADER_SIZE + 34),
         ]
         for tt in tests:
             self.kv_test(tt)
@@ -88,6 +91,18 @@ class TestEncodeKV(unittest.TestCase):
             tt = KeyValue(*get_random_kv())
             self.kv_test(tt)
 
+    def test_corrupt(self) -> None:
+        _, data = encode_kv(10, "hello", "world")
+        corrupt = data[:-1] + b"x"
+        self.assertRaises(ValueError, decode_kv, corrupt)
+
+    def test_bytes(self) -> None:
+        tt = KeyValue(*get_random_kv())
+        self.assertEqual(
+            encode_kv(tt.timestamp, tt.key, tt.val),
+            encode_kv_bytes(tt.timestamp, tt.key.encode(), tt.val.encode()),
+        )
+
 
 class TestKeyEntry(unittest.TestCase):
     # dumb test to increase the coverage